@@ -14,14 +14,10 @@
 # Needs:
 #
 # pip install skyfield
-# pip install arrow
 # pip install pytz
-# pip install ics
 #
-# pip yelled at me that I got the latest arrow (0.12.something) and it
-# was incompatible with ics (it wanted some exact 0.4.somethin version
-# of arrow).  But it still seemed to produce good enough ICS files
-# that imported just fine into Google Calendar.
+# The ICS file is written out by hand (it's a simple text format), so
+# the ics and arrow packages are no longer needed.
 #
 # NOTE: Don't try to import more than a year or two of ICS data to
 # Google Calendar at a time.  I tried to import a 5-year ICS file and
@@ -34,12 +30,10 @@
 
 import os
 import pytz
-import arrow
+import uuid
+import pickle
 import datetime
 
-from skyfield import api, almanac
-from ics import Calendar, Event
-
 ################################################################
 
 # Arguments
@@ -49,9 +43,10 @@ from ics import Calendar, Event
 filename      = 'de421.bsp'
 
 # Obtained from Google Maps (roughly the center of downtown
-# Louisville)
-longitude     = 38.251505
-latitude      = 85.758796
+# Louisville).  Degrees north of the equator and east of Greenwich
+# (i.e., west is negative).
+latitude      = 38.251505
+longitude     = -85.758796
 
 # My local timezone name.
 local_tz_name = 'America/Louisville'
@@ -69,100 +64,192 @@ pm_off_time   = datetime.time(hour=23, minute=15)
 
 ################################################################
 
-# Download / load the JPL file
+# Download / load the JPL file and the timescale.
+
+def load_skyfield(filename):
+    from skyfield import api
 
-if os.path.exists(filename):
-    print("Loading already-downloaded {f} file from JPL..."
-          .format(f=filename))
-    planets = api.load_file(filename)
-else:
-    print("Downloading planets file {f} from JPL..."
-          .format(f=filename))
-    planets = api.load(filename)
+    if os.path.exists(filename):
+        print("Loading already-downloaded {f} file from JPL..."
+              .format(f=filename))
+        planets = api.load_file(filename)
+    else:
+        print("Downloading planets file {f} from JPL..."
+              .format(f=filename))
+        planets = api.load(filename)
+
+    # See https://github.com/skyfielders/python-skyfield/issues/218
+    # "maia.usno.navy.mil" is not resolving in DNS for me.  I used the
+    # "download the cached file from Google" trick to manually
+    # download deltat.data and deltat.preds and put them in the same
+    # folder where this file lives, and then skyfield just loads those
+    # local files.
+    print("Loading timescale...")
+    ts = api.load.timescale()
+
+    return planets, ts
 
 ################################################################
 
-# See https://github.com/skyfielders/python-skyfield/issues/218
-# "maia.usno.navy.mil" is not resolving in DNS for me.  I used the
-# "download the cached file from Google" trick to manually download
-# deltat.data and deltat.preds and put them in the same folder where
-# this file lives, and then skyfield just loads those local files.
-print("Loading timescale...")
-ts = api.load.timescale()
-
-#--------------------------------
-
-print("Seting up constants...")
-here = api.Topos('{l} N'.format(l=longitude),
-                 '{l} W'.format(l=latitude))
-
-calendar        = Calendar()
-one_day         = datetime.timedelta(days=1)
-fifteen_minutes = datetime.timedelta(minutes=15)
-num_events      = 0
-
-#--------------------------------
-
-print("Looping over dates...")
-d    = start_date
-func = almanac.sunrise_sunset(planets, here)
-while d <= stop_date:
-    t1 = ts.utc(d)
-    t2 = ts.utc(d + one_day)
-    times, _ = almanac.find_discrete(t1, t2, func)
-
-    sunrise = times[0].astimezone(local_tz)
-    sunset  = times[1].astimezone(local_tz)
-    #print("Sunrise: {sunrise}, sunset: {sunset}"
-    #      .format(sunrise=sunrise, sunset=sunset))
-
-    # The precision of IFTTT isn't that great (deliver events +/- 5 to
-    # 10 minutes.  So only bother to do something if sunrise is at
-    # least 15 minutes after our desired on time.
-
-    # Make sure to use the same timezone as the computed sunrise time
-    start = datetime.datetime(year=d.year,
-                              month=d.month,
-                              day=d.day,
-                              hour=am_on_time.hour,
-                              minute=am_on_time.minute,
-                              tzinfo=sunrise.tzinfo)
-
-    if sunrise - start >= fifteen_minutes:
-        event       = Event()
-        event.name  = "Morning landscaping lights"
-        event.begin = arrow.get(start)
-        event.end   = arrow.get(sunrise)
-        calendar.events.add(event)
-        num_events += 1
-        print("AM on event: {start} - {end}"
-              .format(start=start, end=sunrise))
-
-    # Make sure to use the same timezone as the computed sunrise time
-    stop = datetime.datetime(year=d.year,
-                             month=d.month,
-                             day=d.day,
-                             hour=pm_off_time.hour,
-                             minute=pm_off_time.minute,
-                             tzinfo=sunrise.tzinfo)
-    event       = Event()
-    event.name  = "Evening landscaping lights"
-    event.begin = arrow.get(sunset)
-    event.end   = arrow.get(stop)
-    calendar.events.add(event)
-    num_events += 1
-    print("PM off event: {start} - {end}"
-          .format(start=sunset, end=stop))
-
-    d += one_day
-
-#--------------------------------
-
-if num_events > 0:
-    filename = 'events.ics'
-    if os.path.exists(filename):
-        os.unlink(filename)
-    with open(filename, 'w') as my_file:
-        my_file.writelines(calendar)
-    print("Wrote {num} events to {f}"
-          .format(num=num_events, f=filename))
+# Returns a list of (date, sunrise, sunset) tuples, one per day from
+# start_date through stop_date, with sunrise/sunset in local time.
+
+def find_sunrises_sunsets(start_date, stop_date, latitude, longitude,
+                          local_tz, filename):
+    # Computing the sunrises/sunsets is deterministic for a given
+    # location and date range, so cache the results on disk next to
+    # the JPL file.  Re-running the script (e.g., to tweak the on/off
+    # times) then doesn't need to redo all the almanac searches.
+    # The results are in local time, so the timezone is part of the key.
+    cache_filename = ('sunrise_{lat}_{lon}_{tz}_{start}_{stop}.pkl'
+                      .format(lat=latitude, lon=longitude,
+                              tz=local_tz.zone.replace('/', '-'),
+                              start=start_date.date(),
+                              stop=stop_date.date()))
+    cache_filename = os.path.join(os.path.dirname(filename),
+                                  cache_filename)
+
+    if os.path.exists(cache_filename):
+        print("Loading cached sunrises and sunsets from {f}..."
+              .format(f=cache_filename))
+        with open(cache_filename, 'rb') as cache_file:
+            return pickle.load(cache_file)
+
+    # Only import / load skyfield (and the JPL file) on a cache miss;
+    # it's by far the slowest part of starting up.
+    from skyfield import api, almanac
+    planets, ts = load_skyfield(filename)
+
+    print("Seting up constants...")
+    here = api.Topos(latitude_degrees=latitude,
+                     longitude_degrees=longitude)
+
+    print("Finding sunrises and sunsets...")
+    func         = almanac.sunrise_sunset(planets, here)
+    t1           = ts.utc(start_date)
+    t2           = ts.utc(stop_date + datetime.timedelta(days=1))
+    times, codes = almanac.find_discrete(t1, t2, func)
+
+    # Convert all the times to the local timezone in one shot
+    local_times  = times.astimezone(local_tz)
+
+    # almanac.sunrise_sunset() reports 1 for sunrise and 0 for sunset.
+    # Pair up each sunrise with the sunset on the same day.
+    days    = []
+    sunrise = None
+    for t, code in zip(local_times, codes):
+        if code == 1:
+            sunrise = t
+        elif sunrise is not None and sunrise.date() == t.date():
+            days.append((sunrise.date(), sunrise, t))
+            sunrise = None
+
+    print("Caching sunrises and sunsets in {f}..."
+          .format(f=cache_filename))
+    # Write to a temp file and then rename it into place so that an
+    # interrupted run can't leave behind a truncated cache file.
+    tmp_filename = cache_filename + '.tmp'
+    with open(tmp_filename, 'wb') as cache_file:
+        pickle.dump(days, cache_file)
+    os.replace(tmp_filename, cache_filename)
+
+    return days
+
+################################################################
+
+# Write an iterable of (name, begin, end) events to an ICS file as
+# they are produced, rather than building up a whole Calendar in
+# memory first.  Times are written in UTC.  Returns the number of
+# events written; if there weren't any, the file is removed.
+
+def write_ics(ics_filename, events):
+    utc    = pytz.utc
+    fmt    = '%Y%m%dT%H%M%SZ'
+    stamp  = datetime.datetime.now(utc).strftime(fmt)
+    count  = 0
+
+    # RFC 5545 wants CRLF line endings
+    with open(ics_filename, 'w', newline='\r\n') as my_file:
+        my_file.write('BEGIN:VCALENDAR\n'
+                      'VERSION:2.0\n'
+                      'PRODID:-//sunrise-sunset//landscaping lights//EN\n')
+        for name, begin, end in events:
+            my_file.write('BEGIN:VEVENT\n'
+                          'UID:{uid}\n'
+                          'DTSTAMP:{stamp}\n'
+                          'DTSTART:{begin}\n'
+                          'DTEND:{end}\n'
+                          'SUMMARY:{name}\n'
+                          'END:VEVENT\n'
+                          .format(uid=uuid.uuid4(), stamp=stamp,
+                                  begin=begin.astimezone(utc).strftime(fmt),
+                                  end=end.astimezone(utc).strftime(fmt),
+                                  name=name))
+            count += 1
+        my_file.write('END:VCALENDAR\n')
+
+    if count == 0:
+        os.unlink(ics_filename)
+
+    return count
+
+################################################################
+
+# Yield the (name, begin, end) landscaping light events.  If
+# am_on_time or pm_off_time is None, skip the morning or evening
+# events (respectively).
+
+def landscaping_events(days, local_tz, am_on_time, pm_off_time):
+    fifteen_minutes = datetime.timedelta(minutes=15)
+
+    print("Looping over dates...")
+    for d, sunrise, sunset in days:
+        #print("Sunrise: {sunrise}, sunset: {sunset}"
+        #      .format(sunrise=sunrise, sunset=sunset))
+
+        # The precision of IFTTT isn't that great (deliver events +/- 5
+        # to 10 minutes.  So only bother to do something if sunrise is
+        # at least 15 minutes after our desired on time.
+
+        # Let pytz pick the right UTC offset (e.g., EST vs. EDT) for
+        # this day
+        if am_on_time is not None:
+            start = local_tz.localize(datetime.datetime.combine(d, am_on_time))
+            if sunrise - start >= fifteen_minutes:
+                print("AM on event: {start} - {end}"
+                      .format(start=start, end=sunrise))
+                yield "Morning landscaping lights", start, sunrise
+
+        if pm_off_time is not None:
+            stop = local_tz.localize(datetime.datetime.combine(d, pm_off_time))
+            print("PM off event: {start} - {end}"
+                  .format(start=sunset, end=stop))
+            yield "Evening landscaping lights", sunset, stop
+
+################################################################
+
+# Generate the landscaping light events and stream them out to
+# events.ics.  Returns the number of events.
+
+def generate(start_date, stop_date, latitude, longitude, local_tz_name,
+             am_on_time=None, pm_off_time=None, filename='de421.bsp'):
+    local_tz = pytz.timezone(local_tz_name)
+    days     = find_sunrises_sunsets(start_date, stop_date,
+                                     latitude, longitude, local_tz,
+                                     filename)
+    events   = landscaping_events(days, local_tz, am_on_time, pm_off_time)
+
+    ics_filename = 'events.ics'
+    num_events   = write_ics(ics_filename, events)
+    if num_events > 0:
+        print("Wrote {num} events to {f}"
+              .format(num=num_events, f=ics_filename))
+
+    return num_events
+
+################################################################
+
+if __name__ == '__main__':
+    generate(start_date, stop_date, latitude, longitude, local_tz_name,
+             am_on_time=am_on_time, pm_off_time=pm_off_time,
+             filename=filename)